@@ -1,33 +1,49 @@
 import os
 import re
+import hmac
+import logging
+import signal
+import secrets
+import functools
 import time
 import sqlite3
 import sys
 import asyncio
 import threading
-from collections import defaultdict, deque
-from typing import Optional, Tuple, Set, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Tuple, Set, FrozenSet, Dict, Iterator, List, Callable, Awaitable
 
-from flask import Flask
+import ahocorasick
+import orjson
+from aiohttp import web
 
 from telegram import (
     Update,
+    Message,
+    MessageEntity,
+    ChatMember,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ChatPermissions,
 )
+from telegram.request import HTTPXRequest
 from telegram.constants import ChatMemberStatus, ParseMode, ChatType
 from telegram.ext import (
+    AIORateLimiter,
     Application,
-    CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
+    Defaults,
     filters,
     ApplicationHandlerStop,
 )
 
 # -------------------- CONFIG --------------------
+log = logging.getLogger(__name__)
+
 OWNER_ID = 5631512980
 BOT_USERNAME = "swipeemanagerbot"  # your bot username without @
 
@@ -36,33 +52,107 @@ DB_PATH = os.getenv("DB_PATH", "group_manager.db")
 
 WELCOME_START_PREFIX = "wel_"  # /start wel_<chat_id>
 
-# Admin cache: chat_id -> {"ids": set(int), "ts": float}
+# Webhook mode: set WEBHOOK_URL (e.g. https://<service>.onrender.com); unset = long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_urlsafe(32)
+
+# Only the update types our handlers consume. edited_message keeps link-lock/blocklist
+# applying to edits; chat_member must be requested explicitly for admin-cache invalidation.
+ALLOWED_UPDATES = [
+    Update.MESSAGE,
+    Update.EDITED_MESSAGE,
+    Update.CALLBACK_QUERY,
+    Update.MY_CHAT_MEMBER,
+    Update.CHAT_MEMBER,
+]
+
+# Admin cache: chat_id -> {"ids": frozenset(int), "members": tuple(ChatMember), "ts": float}
 ADMIN_CACHE: Dict[int, Dict[str, object]] = {}
-ADMIN_CACHE_TTL = 10 * 60  # 10 minutes
+ADMIN_CACHE_TTL = 10 * 60  # 10 minutes (entries are also dropped on promote/demote)
+ADMIN_REFRESHES: Dict[int, asyncio.Future] = {}  # chat_id -> in-flight admin fetch
+ADMIN_GENERATIONS: Dict[int, int] = {}  # chat_id -> bumped on promote/demote
+CHAT_LOCKS_KEY = "chat_locks"  # bot_data slot: chat_id -> asyncio.Lock
+
+# Settings cache: chat_id -> chat_settings row (kept in sync by set_setting)
+SETTINGS_CACHE: Dict[int, dict] = {}
+SETTINGS_LOCK = threading.Lock()
 
-# In-memory antiflood buckets: (chat_id, user_id) -> deque[timestamps]
-FLOOD_BUCKETS = defaultdict(lambda: deque(maxlen=20))
+# Blocklist cache: chat_id -> (phrases, Aho-Corasick automaton or None if empty)
+BLOCK_CACHE: Dict[int, Tuple[List[str], Optional[ahocorasick.Automaton]]] = {}
+
+# In-memory antiflood token buckets: (chat_id, user_id) -> (tokens, last monotonic ts)
+FLOOD_BUCKETS: Dict[Tuple[int, int], Tuple[float, float]] = {}
+FLOOD_SWEEP_INTERVAL = 5 * 60  # 5 minutes
 
 LINK_RE = re.compile(r"(https?://|t\.me/|www\.)", re.IGNORECASE)
+COMMAND_RE = re.compile(r"/([^\s@]+)(?:@(\S+))?")  # /name[@botname]
+PLACEHOLDER_RE = re.compile(r"\{(mention|first|last|username)\}")
 
 # -------------------- WEB (for UptimeRobot / Render) --------------------
-web_app = Flask(__name__)
+# Served from the bot's own event loop (started in post_init), no extra thread.
+# In webhook mode the same server also receives Telegram updates.
+WEB_RUNNER_KEY = "web_runner"  # bot_data slot: aiohttp AppRunner
+PTB_APP_KEY = web.AppKey("ptb_app", Application)
+
+
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="OK")
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="healthy")
+
 
-@web_app.get("/")
-def home():
-    return "OK", 200
+async def telegram_webhook(request: web.Request) -> web.Response:
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # compare bytes: str compare_digest raises on non-ASCII, and aiohttp keeps raw header
+    # bytes as surrogate escapes, so encode them back the same way
+    if not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    app = request.app[PTB_APP_KEY]
+    try:
+        update = Update.de_json(orjson.loads(await request.read()), app.bot)
+    except Exception:
+        return web.Response(status=400)
+    await app.update_queue.put(update)
+    return web.Response()
 
-@web_app.get("/health")
-def health():
-    return "healthy", 200
 
+def build_web_app(app: Application) -> web.Application:
+    web_app = web.Application()
+    web_app[PTB_APP_KEY] = app
+    web_app.router.add_get("/", home)
+    web_app.router.add_get("/health", health)
+    if WEBHOOK_URL:
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
 
-def run_web():
+
+async def start_web(app: Application):
     port = int(os.getenv("PORT", "10000"))  # Render sets PORT automatically for Web Services
-    web_app.run(host="0.0.0.0", port=port)
+    runner = web.AppRunner(build_web_app(app))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    app.bot_data[WEB_RUNNER_KEY] = runner
+
+
+async def stop_web(app: Application):
+    runner = app.bot_data.pop(WEB_RUNNER_KEY, None)
+    if runner is not None:
+        await runner.cleanup()
 
 
 # -------------------- PYTHON 3.14 EVENT LOOP FIX --------------------
+def install_uvloop():
+    # faster drop-in loop on Linux/macOS; silently keep asyncio's loop elsewhere
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 def ensure_event_loop():
     if sys.platform.startswith("win"):
         try:
@@ -85,97 +175,231 @@ def ensure_event_loop():
 
 
 # -------------------- DB --------------------
+# Pragmas applied once on the shared connection (see init_db)
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=134217728;",
+    "PRAGMA busy_timeout=30000;",
+    "PRAGMA cache_size=-20000;",
+)
+DB_OPTIMIZE_INTERVAL = 15 * 60  # 15 minutes
+DB_CHECKPOINT_INTERVAL = 5 * 60  # 5 minutes
+
+_CONN: Optional[sqlite3.Connection] = None
+_LOCK = threading.Lock()
+
+# Single worker that owns all DB access: queries never block the event loop and stay ordered
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
 def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    return conn
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    return _CONN
 
 
-def init_db():
+@contextmanager
+def db_write() -> Iterator[sqlite3.Connection]:
+    """Run the enclosed statements as one BEGIN IMMEDIATE ... COMMIT batch."""
     conn = db()
-    cur = conn.cursor()
+    with _LOCK:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS chat_settings (
-            chat_id INTEGER PRIMARY KEY,
 
-            antiflood_enabled INTEGER DEFAULT 1,
-            flood_limit INTEGER DEFAULT 6,
-            flood_window_sec INTEGER DEFAULT 8,
-            flood_action_mute_sec INTEGER DEFAULT 60,
+async def run_db(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, fn, *args)
 
-            link_lock_enabled INTEGER DEFAULT 0,
-            blocklist_enabled INTEGER DEFAULT 1,
 
-            greetings_enabled INTEGER DEFAULT 1,
-            welcome_text TEXT DEFAULT 'Welcome, {mention}!',
+def db_optimize():
+    with _LOCK:
+        db().execute("PRAGMA optimize;")
 
-            clean_commands_enabled INTEGER DEFAULT 0
-        )
-        """
-    )
 
-    cur.execute(
+def db_checkpoint():
+    with _LOCK:
+        db().execute("PRAGMA wal_checkpoint(PASSIVE);")
+
+
+def close_db():
+    global _CONN
+    with _LOCK:
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+
+KEYED_TABLES = (
+    (
+        "warnings",
         """
         CREATE TABLE IF NOT EXISTS warnings (
             chat_id INTEGER,
             user_id INTEGER,
             count INTEGER DEFAULT 0,
             PRIMARY KEY(chat_id, user_id)
-        )
-        """
-    )
-
-    cur.execute(
+        ) WITHOUT ROWID
+        """,
+    ),
+    (
+        "blocklist",
         """
         CREATE TABLE IF NOT EXISTS blocklist (
             chat_id INTEGER,
             phrase TEXT,
             PRIMARY KEY(chat_id, phrase)
-        )
-        """
-    )
-
-    cur.execute(
+        ) WITHOUT ROWID
+        """,
+    ),
+    (
+        "notes",
         """
         CREATE TABLE IF NOT EXISTS notes (
             chat_id INTEGER,
             name TEXT,
             content TEXT,
             PRIMARY KEY(chat_id, name)
-        )
-        """
-    )
+        ) WITHOUT ROWID
+        """,
+    ),
+)
+
 
-    conn.commit()
-    conn.close()
+def _rebuild_without_rowid(cur: sqlite3.Cursor, table: str, ddl: str):
+    # one-time migration for databases created before the tables were WITHOUT ROWID
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+    if row is None or "WITHOUT ROWID" in row[0].upper():
+        return
+    cur.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    cur.execute(ddl)
+    cur.execute(f"INSERT INTO {table} SELECT * FROM {table}_old")
+    cur.execute(f"DROP TABLE {table}_old")
 
 
-def ensure_chat_row(chat_id: int):
+def init_db():
     conn = db()
-    conn.execute("INSERT OR IGNORE INTO chat_settings(chat_id) VALUES(?)", (chat_id,))
-    conn.commit()
-    conn.close()
+    with _LOCK:
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
 
+    with db_write() as conn:
+        cur = conn.cursor()
 
-def get_settings(chat_id: int) -> dict:
-    ensure_chat_row(chat_id)
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM chat_settings WHERE chat_id=?", (chat_id,))
-    row = cur.fetchone()
-    cols = [d[0] for d in cur.description]
-    conn.close()
-    return dict(zip(cols, row))
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chat_settings (
+                chat_id INTEGER PRIMARY KEY,
 
+                antiflood_enabled INTEGER DEFAULT 1,
+                flood_limit INTEGER DEFAULT 6,
+                flood_window_sec INTEGER DEFAULT 8,
+                flood_action_mute_sec INTEGER DEFAULT 60,
 
-def set_setting(chat_id: int, key: str, value):
-    ensure_chat_row(chat_id)
-    conn = db()
-    conn.execute(f"UPDATE chat_settings SET {key}=? WHERE chat_id=?", (value, chat_id))
-    conn.commit()
-    conn.close()
+                link_lock_enabled INTEGER DEFAULT 0,
+                blocklist_enabled INTEGER DEFAULT 1,
+
+                greetings_enabled INTEGER DEFAULT 1,
+                welcome_text TEXT DEFAULT 'Welcome, {mention}!',
+
+                clean_commands_enabled INTEGER DEFAULT 0
+            )
+            """
+        )
+
+        # composite-key tables: WITHOUT ROWID stores rows in the PK B-tree itself
+        for table, ddl in KEYED_TABLES:
+            _rebuild_without_rowid(cur, table, ddl)
+            cur.execute(ddl)
+
+
+SETTINGS_COLS = (
+    "chat_id",
+    "antiflood_enabled",
+    "flood_limit",
+    "flood_window_sec",
+    "flood_action_mute_sec",
+    "link_lock_enabled",
+    "blocklist_enabled",
+    "greetings_enabled",
+    "welcome_text",
+    "clean_commands_enabled",
+)
+SETTINGS_SQL = f"SELECT {', '.join(SETTINGS_COLS)} FROM chat_settings WHERE chat_id=?"
+
+
+def ensure_chat_row(chat_id: int):
+    with db_write() as conn:
+        conn.execute("INSERT OR IGNORE INTO chat_settings(chat_id) VALUES(?)", (chat_id,))
+
+
+def _load_settings(chat_id: int) -> dict:
+    with SETTINGS_LOCK:
+        cached = SETTINGS_CACHE.get(chat_id)
+        if cached is not None:
+            return cached
+        with _LOCK:
+            row = db().execute(SETTINGS_SQL, (chat_id,)).fetchone()
+        if row is None:
+            # first sight of this chat: create the defaults row and read it back atomically
+            with db_write() as conn:
+                conn.execute("INSERT OR IGNORE INTO chat_settings(chat_id) VALUES(?)", (chat_id,))
+                row = conn.execute(SETTINGS_SQL, (chat_id,)).fetchone()
+        s = dict(zip(SETTINGS_COLS, row))
+        SETTINGS_CACHE[chat_id] = s
+        return s
+
+
+def preload_settings() -> int:
+    # warm the cache once at startup so known chats never read settings from disk
+    with _LOCK:
+        rows = db().execute(f"SELECT {', '.join(SETTINGS_COLS)} FROM chat_settings").fetchall()
+    with SETTINGS_LOCK:
+        for row in rows:
+            SETTINGS_CACHE.setdefault(row[0], dict(zip(SETTINGS_COLS, row)))
+    return len(rows)
+
+
+async def get_settings(chat_id: int) -> dict:
+    # lock-free fast path; only a cache miss waits on the DB worker
+    s = SETTINGS_CACHE.get(chat_id)
+    if s is None:
+        s = await run_db(_load_settings, chat_id)
+    return s
+
+
+def set_settings(chat_id: int, values: dict) -> dict:
+    # keys are interpolated into SQL, so they must be known columns
+    keys = list(values)
+    for key in keys:
+        if key not in SETTINGS_COLS or key == "chat_id":
+            raise ValueError(f"Unknown setting: {key}")
+    with db_write() as conn:
+        row = conn.execute(
+            f"INSERT INTO chat_settings(chat_id, {', '.join(keys)}) VALUES(?{',?' * len(keys)}) "
+            f"ON CONFLICT(chat_id) DO UPDATE SET {', '.join(f'{k}=excluded.{k}' for k in keys)} "
+            f"RETURNING {', '.join(SETTINGS_COLS)}",
+            (chat_id, *values.values()),
+        ).fetchone()
+    s = dict(zip(SETTINGS_COLS, row))
+    cached = SETTINGS_CACHE.get(chat_id)
+    if cached is None:
+        SETTINGS_CACHE[chat_id] = s
+        return s
+    cached.update(s)
+    return cached
+
+
+def set_setting(chat_id: int, key: str, value) -> dict:
+    return set_settings(chat_id, {key: value})
 
 
 # -------------------- Helpers / Access --------------------
@@ -191,24 +415,65 @@ def is_owner(user_id: int) -> bool:
     return user_id == OWNER_ID
 
 
-async def refresh_admin_cache(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> Set[int]:
-    admins = await context.bot.get_chat_administrators(chat_id)
-    admin_ids = {a.user.id for a in admins}
-    ADMIN_CACHE[chat_id] = {"ids": admin_ids, "ts": time.time()}
-    return admin_ids
+async def _fetch_admins(bot, chat_id: int) -> dict:
+    generation = ADMIN_GENERATIONS.get(chat_id, 0)
+    admins = await bot.get_chat_administrators(chat_id)
+    entry = {"ids": frozenset(a.user.id for a in admins), "members": tuple(admins), "ts": time.time()}
+    # a promote/demote seen mid-fetch makes this list stale; hand it back but don't cache it
+    if ADMIN_GENERATIONS.get(chat_id, 0) == generation:
+        ADMIN_CACHE[chat_id] = entry
+    return entry
+
+
+def _refresh_done(chat_id: int, fut: asyncio.Future):
+    # an invalidation may already have replaced this entry with a newer fetch
+    if ADMIN_REFRESHES.get(chat_id) is fut:
+        del ADMIN_REFRESHES[chat_id]
+
 
+async def refresh_admin_cache(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> dict:
+    # concurrent misses for the same chat share one getChatAdministrators call
+    pending = ADMIN_REFRESHES.get(chat_id)
+    if pending is None:
+        pending = asyncio.ensure_future(_fetch_admins(context.bot, chat_id))
+        ADMIN_REFRESHES[chat_id] = pending
+        pending.add_done_callback(functools.partial(_refresh_done, chat_id))
+    return await asyncio.shield(pending)
 
-async def get_admin_ids(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> Set[int]:
+
+def cached_admin_ids(chat_id: int) -> Optional[FrozenSet[int]]:
+    """Fresh cached admin ids, or None if the cache is cold/expired (no I/O)."""
+    cached = ADMIN_CACHE.get(chat_id)
+    if cached and (time.time() - float(cached["ts"])) < ADMIN_CACHE_TTL:
+        return cached["ids"]  # type: ignore
+    return None
+
+
+async def get_admin_ids(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> FrozenSet[int]:
+    admin_ids = cached_admin_ids(chat_id)
+    if admin_ids is not None:
+        return admin_ids
+    try:
+        return (await refresh_admin_cache(context, chat_id))["ids"]
+    except Exception:
+        cached = ADMIN_CACHE.get(chat_id)
+        if cached:
+            return cached["ids"]  # type: ignore
+        return frozenset()
+
+
+async def get_admins(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> Tuple[ChatMember, ...]:
+    """Cached ChatMember list; raises only if Telegram fails and nothing is cached."""
     cached = ADMIN_CACHE.get(chat_id)
-    now = time.time()
-    if cached and (now - float(cached["ts"])) < ADMIN_CACHE_TTL:
-        return set(cached["ids"])  # type: ignore
+    if cached and (time.time() - float(cached["ts"])) < ADMIN_CACHE_TTL:
+        return cached["members"]  # type: ignore
     try:
-        return await refresh_admin_cache(context, chat_id)
+        # use the fetched entry itself: the cache may be invalidated again before we resume
+        return (await refresh_admin_cache(context, chat_id))["members"]
     except Exception:
         if cached:
-            return set(cached["ids"])  # type: ignore
-        return set()
+            return cached["members"]  # type: ignore
+        raise
 
 
 async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
@@ -219,16 +484,133 @@ async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, use
         return False
     if chat.type == ChatType.PRIVATE:
         return True
-    admin_ids = await get_admin_ids(context, chat.id)
-    return user_id in admin_ids
 
+    return user_id in await get_admin_ids(context, chat.id)
+
+
+def per_chat_serialized(fn):
+    """Run an order-sensitive handler for one chat at a time (handlers are non-blocking)."""
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat = update.effective_chat
+        if not chat:
+            return await fn(update, context)
+        locks = context.bot_data.setdefault(CHAT_LOCKS_KEY, {})
+        lock = locks.get(chat.id)
+        if lock is None:
+            lock = locks[chat.id] = asyncio.Lock()
+        async with lock:
+            return await fn(update, context)
 
-def extract_command(text: str) -> str:
-    if not text or not text.startswith("/"):
+    return wrapper
+
+
+def match_command(text: str, bot_username: str) -> str:
+    """Name of one of our commands addressed to us, or "" (unknown / /cmd@otherbot)."""
+    m = COMMAND_RE.match(text) if text else None
+    if not m:
+        return ""
+    name = m.group(1).lower()
+    if name not in KNOWN_COMMANDS:
+        return ""
+    target = m.group(2)
+    if target and target.lower() != bot_username.lower():
         return ""
-    cmd = text.split()[0]
-    cmd = cmd.split("@")[0]
-    return cmd[1:].lower()
+    return name
+
+
+# -------------------- Outbound reply coalescing --------------------
+# Replies queued within one window for the same chat (and forum topic) go out as a single message
+OUT_COALESCE_WINDOW = 0.2  # seconds
+OUT_MAX_LEN = 4096  # Telegram message length limit
+OUT_BUFFERS: Dict[Tuple[int, Optional[int]], List[str]] = {}  # (chat_id, thread_id) -> texts
+
+
+def enqueue_reply(context: ContextTypes.DEFAULT_TYPE, msg: Message, text: str):
+    # answer in the topic the command came from, as reply_text would
+    key = (msg.chat_id, msg.message_thread_id if msg.is_topic_message else None)
+    pending = OUT_BUFFERS.get(key)
+    if pending is not None:
+        pending.append(text)
+        return
+    OUT_BUFFERS[key] = [text]
+    spawn(flush_replies(context.bot, key))
+
+
+def pack_replies(items: List[str]) -> List[str]:
+    chunks: List[str] = []
+    for text in items:
+        if chunks and len(chunks[-1]) + 1 + len(text) <= OUT_MAX_LEN:
+            chunks[-1] += "\n" + text
+        else:
+            chunks.append(text)
+    return chunks
+
+
+async def flush_replies(bot, key: Tuple[int, Optional[int]]):
+    await asyncio.sleep(OUT_COALESCE_WINDOW)
+    chat_id, thread_id = key
+    for chunk in pack_replies(OUT_BUFFERS.pop(key, [])):
+        try:
+            await bot.send_message(chat_id, chunk, message_thread_id=thread_id)
+        except Exception:
+            log.exception("Failed to send coalesced reply to chat %s", chat_id)
+
+
+# -------------------- Chat member updates --------------------
+async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cmu = update.my_chat_member
+    if not cmu or cmu.chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
+        return
+    joined = (ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR)
+    if cmu.new_chat_member.status in joined and cmu.old_chat_member.status not in joined:
+        await run_db(ensure_chat_row, cmu.chat.id)
+
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # someone was promoted or demoted: the cached admin list is stale
+    cmu = update.chat_member
+    if not cmu:
+        return
+    admin = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+    if (cmu.old_chat_member.status in admin) != (cmu.new_chat_member.status in admin):
+        chat_id = cmu.chat.id
+        ADMIN_GENERATIONS[chat_id] = ADMIN_GENERATIONS.get(chat_id, 0) + 1
+        ADMIN_CACHE.pop(chat_id, None)
+        # later lookups start a fresh fetch instead of joining the superseded one
+        ADMIN_REFRESHES.pop(chat_id, None)
+
+
+# -------------------- Filters --------------------
+GROUP_CHAT_TYPES = (ChatType.GROUP, ChatType.SUPERGROUP)
+
+
+def _starts_with_command(message: Message) -> bool:
+    # same test as filters.COMMAND: a bot_command entity at offset 0
+    entities = message.entities
+    return bool(entities) and entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0
+
+
+class GroupCommand(filters.MessageFilter):
+    """filters.ChatType.GROUPS & filters.COMMAND in one call."""
+
+    __slots__ = ()
+
+    def filter(self, message: Message) -> bool:
+        return message.chat.type in GROUP_CHAT_TYPES and _starts_with_command(message)
+
+
+class GroupPlainText(filters.MessageFilter):
+    """filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND in one call."""
+
+    __slots__ = ()
+
+    def filter(self, message: Message) -> bool:
+        return bool(message.text) and message.chat.type in GROUP_CHAT_TYPES and not _starts_with_command(message)
+
+
+GROUP_COMMAND = GroupCommand(name="GroupCommand")
+GROUP_TEXT = GroupPlainText(name="GroupPlainText")
 
 
 # -------------------- PM HELP BUTTON (LIKE SCREENSHOT) --------------------
@@ -244,6 +626,7 @@ async def group_command_gate(update: Update, context: ContextTypes.DEFAULT_TYPE)
     In groups: block ALL commands for non-admins/non-owner.
     Exceptions allowed for everyone:
       /admin, /info, /help, /start
+    Commands we don't handle (or meant for other bots) are ignored.
     """
     if not is_group(update):
         return
@@ -253,15 +636,24 @@ async def group_command_gate(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not msg or not user or not msg.text:
         return
 
-    cmd = extract_command(msg.text)
+    cmd = match_command(msg.text, context.bot.username)
+    if not cmd:
+        return
 
     # Commands allowed for ALL members:
     if cmd in ("admin", "info", "help", "start"):
         return
 
-    # Everything else: admins/owner only
-    if not await is_group_admin(update, context, user.id):
-        await msg.reply_text("You are not an admin.\nUse /admin to check the admins of this group.")
+    # Everything else: admins/owner only.
+    # Warm cache is answered synchronously so this blocking gate never yields.
+    admin_ids = cached_admin_ids(update.effective_chat.id)
+    if admin_ids is not None:
+        allowed = is_owner(user.id) or user.id in admin_ids
+    else:
+        allowed = await is_group_admin(update, context, user.id)
+    if not allowed:
+        # don't hold this blocking gate while the reply waits on the rate limiter
+        spawn(msg.reply_text("You are not an admin.\nUse /admin to check the admins of this group."))
         raise ApplicationHandlerStop
 
 
@@ -347,7 +739,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
 
             context.user_data["awaiting_welcome_for"] = chat_id
-            current = get_settings(chat_id).get("welcome_text", "Welcome, {mention}!")
+            current = (await get_settings(chat_id)).get("welcome_text", "Welcome, {mention}!")
             await update.effective_message.reply_text(
                 "Send me the new welcome message now.\n\n"
                 "Placeholders:\n"
@@ -369,7 +761,7 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     chat = update.effective_chat
     try:
-        admins = await context.bot.get_chat_administrators(chat.id)
+        admins = await get_admins(context, chat.id)
         lines = ["✅ <b>Group admins:</b>"]
         for a in admins:
             u = a.user
@@ -418,23 +810,35 @@ async def cmd_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # -------------------- Settings --------------------
-def settings_keyboard(s: dict) -> InlineKeyboardMarkup:
-    def onoff(v: int) -> str:
+SETTINGS_TOGGLES = (
+    ("Antiflood", "antiflood_enabled"),
+    ("Link Lock", "link_lock_enabled"),
+    ("Blocklist", "blocklist_enabled"),
+    ("Greetings", "greetings_enabled"),
+    ("Clean Cmds", "clean_commands_enabled"),
+)
+
+
+@functools.lru_cache(maxsize=2 ** len(SETTINGS_TOGGLES))
+def _settings_keyboard(bits: Tuple[bool, ...]) -> InlineKeyboardMarkup:
+    # markups are immutable, so one instance per on/off combination is shared
+    def onoff(v: bool) -> str:
         return "✅ ON" if v else "❌ OFF"
 
     buttons = [
-        [InlineKeyboardButton(f"Antiflood: {onoff(s['antiflood_enabled'])}", callback_data="tog:antiflood_enabled")],
-        [InlineKeyboardButton(f"Link Lock: {onoff(s['link_lock_enabled'])}", callback_data="tog:link_lock_enabled")],
-        [InlineKeyboardButton(f"Blocklist: {onoff(s['blocklist_enabled'])}", callback_data="tog:blocklist_enabled")],
-        [InlineKeyboardButton(f"Greetings: {onoff(s['greetings_enabled'])}", callback_data="tog:greetings_enabled")],
-        [InlineKeyboardButton(f"Clean Cmds: {onoff(s['clean_commands_enabled'])}", callback_data="tog:clean_commands_enabled")],
+        [InlineKeyboardButton(f"{label}: {onoff(bit)}", callback_data=f"tog:{key}")]
+        for (label, key), bit in zip(SETTINGS_TOGGLES, bits)
     ]
     return InlineKeyboardMarkup(buttons)
 
 
+def settings_keyboard(s: dict) -> InlineKeyboardMarkup:
+    return _settings_keyboard(tuple(bool(s[key]) for _, key in SETTINGS_TOGGLES))
+
+
 async def cmd_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    s = get_settings(chat_id)
+    s = await get_settings(chat_id)
     await update.effective_message.reply_text(
         "⚙️ *Group Settings*",
         reply_markup=settings_keyboard(s),
@@ -442,19 +846,19 @@ async def cmd_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@per_chat_serialized
 async def on_settings_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
     chat_id = update.effective_chat.id
     data = q.data
-    s = get_settings(chat_id)
+    s = await get_settings(chat_id)
 
     if data.startswith("tog:"):
         key = data.split(":", 1)[1]
         new_val = 0 if s[key] else 1
-        set_setting(chat_id, key, new_val)
-        s = get_settings(chat_id)
+        s = await run_db(set_setting, chat_id, key, new_val)
         await q.edit_message_reply_markup(reply_markup=settings_keyboard(s))
 
 
@@ -507,8 +911,7 @@ async def handle_private_welcome_text(update: Update, context: ContextTypes.DEFA
         await update.effective_message.reply_text("Send a valid text.")
         return
 
-    set_setting(int(chat_id), "welcome_text", text)
-    set_setting(int(chat_id), "greetings_enabled", 1)
+    await run_db(set_settings, int(chat_id), {"welcome_text": text, "greetings_enabled": 1})
 
     context.user_data.pop("awaiting_welcome_for", None)
     await update.effective_message.reply_text("✅ Welcome message updated and enabled for that group.")
@@ -520,19 +923,15 @@ def render_welcome(template: str, user) -> str:
     last = (user.last_name or "")
     username = f"@{user.username}" if user.username else ""
 
-    out = template or "Welcome, {mention}!"
-    out = out.replace("{mention}", mention)
-    out = out.replace("{first}", first)
-    out = out.replace("{last}", last)
-    out = out.replace("{username}", username)
-    return out
+    values = {"mention": mention, "first": first, "last": last, "username": username}
+    return PLACEHOLDER_RE.sub(lambda m: values[m.group(1)], template or "Welcome, {mention}!")
 
 
 async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_group(update):
         return
     chat_id = update.effective_chat.id
-    s = get_settings(chat_id)
+    s = await get_settings(chat_id)
     if not s.get("greetings_enabled", 1):
         return
 
@@ -543,30 +942,28 @@ async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # -------------------- Warnings (3 -> 4th BAN) --------------------
 def get_warn_count(chat_id: int, user_id: int) -> int:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT count FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    row = cur.fetchone()
-    conn.close()
+    with _LOCK:
+        row = db().execute(
+            "SELECT count FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id)
+        ).fetchone()
     return row[0] if row else 0
 
 
-def set_warn_count(chat_id: int, user_id: int, count: int):
-    conn = db()
-    conn.execute(
-        "INSERT INTO warnings(chat_id, user_id, count) VALUES(?,?,?) "
-        "ON CONFLICT(chat_id, user_id) DO UPDATE SET count=excluded.count",
-        (chat_id, user_id, count),
-    )
-    conn.commit()
-    conn.close()
+def add_warn(chat_id: int, user_id: int) -> int:
+    # read-modify-write in one statement so concurrent /warn calls can't lose a count
+    with db_write() as conn:
+        row = conn.execute(
+            "INSERT INTO warnings(chat_id, user_id, count) VALUES(?,?,1) "
+            "ON CONFLICT(chat_id, user_id) DO UPDATE SET count=count+1 "
+            "RETURNING count",
+            (chat_id, user_id),
+        ).fetchone()
+    return row[0]
 
 
 def reset_warns(chat_id: int, user_id: int):
-    conn = db()
-    conn.execute("DELETE FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("DELETE FROM warnings WHERE chat_id=? AND user_id=?", (chat_id, user_id))
 
 
 def parse_target_user(update: Update) -> Optional[int]:
@@ -585,6 +982,7 @@ def parse_reason_and_arg(text: str) -> Tuple[str, str]:
     return parts[1], parts[2]
 
 
+@per_chat_serialized
 async def cmd_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_group(update):
         return
@@ -597,11 +995,10 @@ async def cmd_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     warn_limit = 4  # 4th = ban
     _, reason = parse_reason_and_arg(update.effective_message.text)
-    count = get_warn_count(chat_id, target) + 1
-    set_warn_count(chat_id, target, count)
+    count = await run_db(add_warn, chat_id, target)
 
     if count >= warn_limit:
-        reset_warns(chat_id, target)
+        await run_db(reset_warns, chat_id, target)
         try:
             await context.bot.ban_chat_member(chat_id, target)
             await update.effective_message.reply_text("🚫 4th warning reached — user banned.")
@@ -616,17 +1013,19 @@ async def cmd_warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     target = parse_target_user(update) or update.effective_user.id
-    count = get_warn_count(chat_id, target)
+    count = await run_db(get_warn_count, chat_id, target)
+    # per-user answer: reply to the asker so it can't merge with someone else's line
     await update.effective_message.reply_text(f"Warnings: {count} (4th = ban)")
 
 
+@per_chat_serialized
 async def cmd_resetwarns(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     target = parse_target_user(update)
     if not target:
         await update.effective_message.reply_text("Reply to a user with /resetwarns.")
         return
-    reset_warns(chat_id, target)
+    await run_db(reset_warns, chat_id, target)
     await update.effective_message.reply_text("✅ Warnings reset.")
 
 
@@ -723,178 +1122,172 @@ async def cmd_del(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # -------------------- Anti-flood & Filters --------------------
-async def antiflood_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    msg = update.effective_message
-    chat = update.effective_chat
-    user = update.effective_user
-    if not msg or not chat or not user:
-        return False
-
-    s = get_settings(chat.id)
+def flood_exceeded(chat_id: int, user_id: int, s: dict) -> bool:
+    """Antiflood decision for one message; pure in-memory (caller already skipped admins)."""
     if not s["antiflood_enabled"]:
         return False
 
-    if await is_group_admin(update, context, user.id):
-        return False
-
-    key = (chat.id, user.id)
-    bucket = FLOOD_BUCKETS[key]
-    now = time.time()
-    bucket.append(now)
-
+    key = (chat_id, user_id)
+    now = time.monotonic()  # immune to wall-clock jumps
     window = s["flood_window_sec"]
     limit = s["flood_limit"]
-    count = sum(1 for t in bucket if now - t <= window)
 
-    if count >= limit:
-        mute_sec = s["flood_action_mute_sec"]
-        until = int(now + mute_sec)
-        try:
-            await context.bot.restrict_chat_member(chat.id, user.id, ChatPermissions(can_send_messages=False), until_date=until)
-        except Exception:
-            pass
-        try:
-            await context.bot.delete_message(chat.id, msg.message_id)
-        except Exception:
-            pass
-        return True
+    # limit-1 tokens are spendable, refilled at (limit-1)/window: bursts trip on the
+    # limit-th message and the sustained ceiling equals the old sliding window's;
+    # steady spam just above that ceiling trips once the burst allowance runs out
+    tokens, last = FLOOD_BUCKETS.get(key, (limit, now))
+    tokens = min(limit, tokens + (now - last) * ((limit - 1) / window)) - 1
+    FLOOD_BUCKETS[key] = (max(tokens, 0.0), now)
+    return tokens < 1
 
-    return False
+
+def sweep_flood_buckets():
+    # an idle bucket is full again after one window, so dropping it is lossless;
+    # buckets of chats that switched antiflood off are never read again
+    now = time.monotonic()
+    for key, (_, last) in list(FLOOD_BUCKETS.items()):
+        s = SETTINGS_CACHE.get(key[0])
+        if not s or not s["antiflood_enabled"] or now - last > s["flood_window_sec"] * 4:
+            FLOOD_BUCKETS.pop(key, None)
 
 
 def add_block(chat_id: int, phrase: str):
     phrase = phrase.strip().lower()
     if not phrase:
         return
-    conn = db()
-    conn.execute("INSERT OR IGNORE INTO blocklist(chat_id, phrase) VALUES(?,?)", (chat_id, phrase))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("INSERT OR IGNORE INTO blocklist(chat_id, phrase) VALUES(?,?)", (chat_id, phrase))
+    BLOCK_CACHE.pop(chat_id, None)
 
 
 def remove_block(chat_id: int, phrase: str):
     phrase = phrase.strip().lower()
-    conn = db()
-    conn.execute("DELETE FROM blocklist WHERE chat_id=? AND phrase=?", (chat_id, phrase))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("DELETE FROM blocklist WHERE chat_id=? AND phrase=?", (chat_id, phrase))
+    BLOCK_CACHE.pop(chat_id, None)
 
 
 def list_block(chat_id: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT phrase FROM blocklist WHERE chat_id=? ORDER BY phrase", (chat_id,))
-    rows = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with _LOCK:
+        cur = db().execute("SELECT phrase FROM blocklist WHERE chat_id=? ORDER BY phrase", (chat_id,))
+        return [r[0] for r in cur.fetchall()]
+
 
+def _load_block_matcher(chat_id: int) -> Tuple[List[str], Optional[ahocorasick.Automaton]]:
+    phrases = [p for p in list_block(chat_id) if p]
+    automaton = None
+    if phrases:
+        # one pass over the text finds any phrase, however long the blocklist is
+        automaton = ahocorasick.Automaton()
+        for phrase in phrases:
+            automaton.add_word(phrase, phrase)
+        automaton.make_automaton()
+    cached = (phrases, automaton)
+    BLOCK_CACHE[chat_id] = cached
+    return cached
 
+
+async def get_block_matcher(chat_id: int) -> Optional[ahocorasick.Automaton]:
+    cached = BLOCK_CACHE.get(chat_id)
+    if cached is None:
+        cached = await run_db(_load_block_matcher, chat_id)
+    return cached[1]
+
+
+@per_chat_serialized
 async def cmd_block(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     parts = update.effective_message.text.split(maxsplit=1)
     if len(parts) < 2:
         await update.effective_message.reply_text("Usage: /block <word_or_phrase>")
         return
-    add_block(chat_id, parts[1])
+    await run_db(add_block, chat_id, parts[1])
     await update.effective_message.reply_text("✅ Added to blocklist.")
 
 
+@per_chat_serialized
 async def cmd_unblock(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     parts = update.effective_message.text.split(maxsplit=1)
     if len(parts) < 2:
         await update.effective_message.reply_text("Usage: /unblock <word_or_phrase>")
         return
-    remove_block(chat_id, parts[1])
+    await run_db(remove_block, chat_id, parts[1])
     await update.effective_message.reply_text("✅ Removed from blocklist.")
 
 
 async def cmd_blocklist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    words = list_block(chat_id)
+    words = await run_db(list_block, chat_id)
     if not words:
-        await update.effective_message.reply_text("Blocklist is empty.")
+        enqueue_reply(context, update.effective_message, "Blocklist is empty.")
         return
-    await update.effective_message.reply_text("🧱 Blocklist:\n- " + "\n- ".join(words))
-
-
-async def filter_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    msg = update.effective_message
-    chat = update.effective_chat
-    user = update.effective_user
-    if not msg or not chat or not user or not msg.text:
-        return False
-
-    s = get_settings(chat.id)
-    if await is_group_admin(update, context, user.id):
-        return False
+    enqueue_reply(context, update.effective_message, "🧱 Blocklist:\n- " + "\n- ".join(words))
 
-    text = msg.text.lower()
 
+async def filter_check(chat_id: int, text: str, s: dict) -> bool:
+    """Link-lock / blocklist decision; only awaits on a cold blocklist cache."""
+    # LINK_RE is case-insensitive, so only the blocklist needs a lowered copy
     if s["link_lock_enabled"] and LINK_RE.search(text):
-        try:
-            await context.bot.delete_message(chat.id, msg.message_id)
-        except Exception:
-            pass
         return True
 
     if s["blocklist_enabled"]:
-        blocked = list_block(chat.id)
-        for phrase in blocked:
-            if phrase and phrase in text:
-                try:
-                    await context.bot.delete_message(chat.id, msg.message_id)
-                except Exception:
-                    pass
-                return True
+        matcher = await get_block_matcher(chat_id)
+        if matcher is not None and next(matcher.iter(text.lower()), None) is not None:
+            return True
 
     return False
 
 
+async def punish(context: ContextTypes.DEFAULT_TYPE, msg: Message, mute_until: Optional[int] = None):
+    # delete (and mute) in parallel: one Bot API round trip instead of two
+    calls = [context.bot.delete_message(msg.chat_id, msg.message_id)]
+    if mute_until is not None:
+        calls.append(
+            context.bot.restrict_chat_member(
+                msg.chat_id, msg.from_user.id, ChatPermissions(can_send_messages=False), until_date=mute_until
+            )
+        )
+    await asyncio.gather(*calls, return_exceptions=True)
+
+
 # -------------------- Notes --------------------
 def save_note(chat_id: int, name: str, content: str):
-    conn = db()
-    conn.execute(
-        "INSERT INTO notes(chat_id, name, content) VALUES(?,?,?) "
-        "ON CONFLICT(chat_id, name) DO UPDATE SET content=excluded.content",
-        (chat_id, name.lower(), content),
-    )
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute(
+            "INSERT INTO notes(chat_id, name, content) VALUES(?,?,?) "
+            "ON CONFLICT(chat_id, name) DO UPDATE SET content=excluded.content",
+            (chat_id, name.lower(), content),
+        )
 
 
 def get_note(chat_id: int, name: str) -> Optional[str]:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT content FROM notes WHERE chat_id=? AND name=?", (chat_id, name.lower()))
-    row = cur.fetchone()
-    conn.close()
+    with _LOCK:
+        row = db().execute(
+            "SELECT content FROM notes WHERE chat_id=? AND name=?", (chat_id, name.lower())
+        ).fetchone()
     return row[0] if row else None
 
 
 def list_notes(chat_id: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM notes WHERE chat_id=? ORDER BY name", (chat_id,))
-    rows = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with _LOCK:
+        cur = db().execute("SELECT name FROM notes WHERE chat_id=? ORDER BY name", (chat_id,))
+        return [r[0] for r in cur.fetchall()]
 
 
 def clear_note(chat_id: int, name: str):
-    conn = db()
-    conn.execute("DELETE FROM notes WHERE chat_id=? AND name=?", (chat_id, name.lower()))
-    conn.commit()
-    conn.close()
+    with db_write() as conn:
+        conn.execute("DELETE FROM notes WHERE chat_id=? AND name=?", (chat_id, name.lower()))
 
 
+@per_chat_serialized
 async def cmd_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     parts = update.effective_message.text.split(maxsplit=2)
     if len(parts) < 3:
         await update.effective_message.reply_text("Usage: /save <name> <content>")
         return
-    save_note(chat_id, parts[1], parts[2])
+    await run_db(save_note, chat_id, parts[1], parts[2])
     await update.effective_message.reply_text("✅ Note saved.")
 
 
@@ -904,7 +1297,7 @@ async def cmd_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(parts) < 2:
         await update.effective_message.reply_text("Usage: /get <name>")
         return
-    note = get_note(chat_id, parts[1])
+    note = await run_db(get_note, chat_id, parts[1])
     if not note:
         await update.effective_message.reply_text("Note not found.")
         return
@@ -913,68 +1306,263 @@ async def cmd_get(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    names = list_notes(chat_id)
+    names = await run_db(list_notes, chat_id)
     if not names:
-        await update.effective_message.reply_text("No notes yet.")
+        enqueue_reply(context, update.effective_message, "No notes yet.")
         return
-    await update.effective_message.reply_text("🗒 Notes:\n- " + "\n- ".join(names))
+    enqueue_reply(context, update.effective_message, "🗒 Notes:\n- " + "\n- ".join(names))
 
 
+@per_chat_serialized
 async def cmd_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     parts = update.effective_message.text.split(maxsplit=1)
     if len(parts) < 2:
         await update.effective_message.reply_text("Usage: /clear <name>")
         return
-    clear_note(chat_id, parts[1])
+    await run_db(clear_note, chat_id, parts[1])
     await update.effective_message.reply_text("✅ Note cleared.")
 
 
 # -------------------- Moderation pipeline --------------------
-async def on_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def on_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Single pass over a group text message: admin + settings once, then
+    decide in memory (flood, link, blocklist) and only then call Telegram.
+    """
     if not is_group(update):
         return
-    if await antiflood_check(update, context):
+
+    msg = update.effective_message
+    user = update.effective_user
+    if not msg or not user or not msg.text:
         return
-    if await filter_check(update, context):
+
+    if await is_group_admin(update, context, user.id):
+        return
+
+    chat_id = msg.chat_id
+    s = await get_settings(chat_id)
+    if flood_exceeded(chat_id, user.id, s):
+        await punish(context, msg, mute_until=int(time.time() + s["flood_action_mute_sec"]))
+        return
+    if await filter_check(chat_id, msg.text, s):
+        await punish(context, msg)
+
+
+# -------------------- Command dispatch --------------------
+CommandCallback = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+# One hash lookup per command instead of walking ~25 CommandHandlers
+CMD_TABLE: Dict[str, CommandCallback] = {
+    # basics
+    "start": cmd_start,
+    "help": cmd_help,
+    # public commands
+    "admin": cmd_admin,
+    "info": cmd_info,
+    # settings
+    "settings": cmd_settings,
+    # welcome setup
+    "setup": cmd_setup,
+    "welcome_setup": cmd_setup,  # alias
+    # warns
+    "warn": cmd_warn,
+    "warnings": cmd_warnings,
+    "resetwarns": cmd_resetwarns,
+    # admin actions
+    "ban": cmd_ban,
+    "unban": cmd_unban,
+    "mute": cmd_mute,
+    "unmute": cmd_unmute,
+    "del": cmd_del,
+    # filters
+    "block": cmd_block,
+    "unblock": cmd_unblock,
+    "blocklist": cmd_blocklist,
+    # notes
+    "save": cmd_save,
+    "get": cmd_get,
+    "notes": cmd_notes,
+    "clear": cmd_clear,
+}
+# Frozen at import: lets the gate and dispatcher drop foreign commands up front
+KNOWN_COMMANDS = frozenset(CMD_TABLE)
+
+
+async def dispatch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    name = match_command(msg.text, context.bot.username) if msg else ""
+    if not name:
         return
 
+    context.args = msg.text.split()[1:]
+    await CMD_TABLE[name](update, context)
+
+
+# -------------------- Background tasks --------------------
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    # keep a strong reference so the task isn't garbage-collected mid-flight
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def run_periodically(interval: float, fn, *args, on_db: bool = True):
+    # DB jobs take a turn on the DB worker; in-memory jobs stay on the loop that owns their state
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if on_db:
+                await run_db(fn, *args)
+            else:
+                fn(*args)
+        except Exception:
+            log.exception("Periodic job %s failed", fn.__name__)
+
+
+async def on_post_init(app: Application):
+    await start_web(app)
+    spawn(run_periodically(DB_OPTIMIZE_INTERVAL, db_optimize))
+    spawn(run_periodically(DB_CHECKPOINT_INTERVAL, db_checkpoint))
+    spawn(run_periodically(FLOOD_SWEEP_INTERVAL, sweep_flood_buckets, on_db=False))
+
+
+async def on_post_stop(app: Application):
+    tasks = list(BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await stop_web(app)
+
+
+async def on_post_shutdown(app: Application):
+    DB_EXECUTOR.shutdown(wait=True)
+    close_db()
+
+
+# -------------------- Webhook runner --------------------
+async def serve_webhook(app: Application):
+    # PTB's run_webhook brings its own server on PORT; we feed update_queue from
+    # the aiohttp app instead, so the lifecycle hooks run_polling calls are called here.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async with app:
+        await app.post_init(app)
+        await app.bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=False,
+        )
+        await app.start()
+        try:
+            await stop.wait()
+        finally:
+            await app.stop()
+            await app.post_stop(app)
+    await app.post_shutdown(app)
+
+
+# -------------------- HTTP --------------------
+class OrjsonRequest(HTTPXRequest):
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        # orjson parses the raw bytes directly; bad UTF-8 falls back to PTB's lenient decoder
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            return HTTPXRequest.parse_json_payload(payload)
+
+
+SEND_ENDPOINTS = ("send", "copyMessage", "forwardMessage")  # prefixes; *Messages included
+
+
+class SendRateLimiter(AIORateLimiter):
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        # Telegram's 20/min group limit covers sending only; keep deletes, restricts, bans and
+        # admin lookups off that bucket. PTB reads only chat_id from `data` (the request itself
+        # travels in `args`), and a non-negative id keeps the overall limit without the group one.
+        if not endpoint.startswith(SEND_ENDPOINTS) and data.get("chat_id") is not None:
+            data = {**data, "chat_id": 0}
+        return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
 
 # -------------------- MAIN --------------------
 def main():
+    install_uvloop()
     ensure_event_loop()
 
     if not BOT_TOKEN:
         raise RuntimeError("Set BOT_TOKEN env var first (BOT_TOKEN).")
 
     init_db()
+    preload_settings()
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # big pool for concurrent handlers; a getUpdates long-poll gets its own small pool
+        .request(
+            OrjsonRequest(
+                connection_pool_size=64,
+                pool_timeout=5.0,
+                connect_timeout=5.0,
+                read_timeout=20.0,
+                write_timeout=20.0,
+            )
+        )
+        .concurrent_updates(256)
+        # every handler runs as its own task; only the command gate opts back into blocking
+        .defaults(Defaults(block=False))
+        # pre-throttle outgoing calls to Telegram's limits and retry 429s transparently
+        .rate_limiter(
+            SendRateLimiter(
+                overall_max_rate=30,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+                max_retries=3,
+            )
+        )
+        .post_init(on_post_init)
+        .post_stop(on_post_stop)
+        .post_shutdown(on_post_shutdown)
+    )
+    if WEBHOOK_URL:
+        # updates arrive through our aiohttp route, no getUpdates poller
+        builder.updater(None)
+    else:
+        builder.get_updates_request(OrjsonRequest(connection_pool_size=2))
+    app = builder.build()
 
-    # Start web server for Render/UptimeRobot in background thread
-    threading.Thread(target=run_web, daemon=True).start()
-
-    app = Application.builder().token(BOT_TOKEN).build()
-
-    # Command gate FIRST
+    # Command gate FIRST (stays blocking so it authorizes before dispatch)
     app.add_handler(
-        MessageHandler(filters.ChatType.GROUPS & filters.COMMAND, group_command_gate),
+        MessageHandler(GROUP_COMMAND, group_command_gate, block=True),
         group=-1
     )
 
-    # basics
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
+    # bot added to a group: create its settings row up front
+    app.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    # public commands
-    app.add_handler(CommandHandler("admin", cmd_admin))
-    app.add_handler(CommandHandler("info", cmd_info))
+    # admin promoted/demoted: invalidate the admin cache
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
 
-    # settings
-    app.add_handler(CommandHandler("settings", cmd_settings))
-    app.add_handler(CallbackQueryHandler(on_settings_click, pattern=r"^tog:"))
+    # all commands (see CMD_TABLE); like CommandHandler, ignore channel posts
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGES & filters.COMMAND, dispatch_command))
 
-    # welcome setup
-    app.add_handler(CommandHandler("setup", cmd_setup))
-    app.add_handler(CommandHandler("welcome_setup", cmd_setup))  # alias
+    # settings buttons
+    app.add_handler(CallbackQueryHandler(on_settings_click, pattern=r"^tog:"))
 
     # DM welcome text receiver
     app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND, handle_private_welcome_text))
@@ -982,33 +1570,21 @@ def main():
     # welcome join handler
     app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, on_new_members))
 
-    # warns
-    app.add_handler(CommandHandler("warn", cmd_warn))
-    app.add_handler(CommandHandler("warnings", cmd_warnings))
-    app.add_handler(CommandHandler("resetwarns", cmd_resetwarns))
-
-    # admin actions
-    app.add_handler(CommandHandler("ban", cmd_ban))
-    app.add_handler(CommandHandler("unban", cmd_unban))
-    app.add_handler(CommandHandler("mute", cmd_mute))
-    app.add_handler(CommandHandler("unmute", cmd_unmute))
-    app.add_handler(CommandHandler("del", cmd_del))
-
-    # filters
-    app.add_handler(CommandHandler("block", cmd_block))
-    app.add_handler(CommandHandler("unblock", cmd_unblock))
-    app.add_handler(CommandHandler("blocklist", cmd_blocklist))
-
-    # notes
-    app.add_handler(CommandHandler("save", cmd_save))
-    app.add_handler(CommandHandler("get", cmd_get))
-    app.add_handler(CommandHandler("notes", cmd_notes))
-    app.add_handler(CommandHandler("clear", cmd_clear))
-
     # moderation for normal messages
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & ~filters.COMMAND, on_text_message))
+    app.add_handler(MessageHandler(GROUP_TEXT, on_group_message))
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        asyncio.get_event_loop().run_until_complete(serve_webhook(app))
+        return
+
+    # long-poll continuously; with concurrent updates the offset advances while handlers run
+    app.run_polling(
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=False,
+        poll_interval=0.0,
+        # Telegram holds each getUpdates up to 50 s; PTB adds this to the read timeout
+        timeout=50,
+    )
 
 
 if __name__ == "__main__":